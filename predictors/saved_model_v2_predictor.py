@@ -16,7 +16,14 @@
 # Lint as: python3
 """Predictor that relies on TF2.x SavedModels."""
 
+import collections
+from concurrent import futures
+import ctypes
 import os
+import queue
+import select
+import sys
+import threading
 import time
 from typing import Dict, Optional, Text
 from absl import logging
@@ -27,8 +34,235 @@ from tensor2robot.predictors import abstract_predictor
 from tensor2robot.utils import tensorspec_utils
 import tensorflow.compat.v2 as tf
 
+_MIN_BUSY_WAITING_SLEEP_TIME_IN_SECS = 0.25
 _BUSY_WAITING_SLEEP_TIME_IN_SECS = 10
 
+# A LRU cache mapping t2r assets paths to their (modification time, size) and
+# the parsed feature and label specs.
+_SPEC_CACHE = collections.OrderedDict()
+_SPEC_CACHE_SIZE = 8
+_SPEC_CACHE_LOCK = threading.Lock()
+
+_QUANTIZATION_MODES = (None, 'fp16', 'int8')
+_TFLITE_INPUT_NAME = 'input_{}'
+_TFLITE_OUTPUT_NAME = 'output_{}'
+
+# inotify event masks, see /usr/include/linux/inotify.h.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+
+
+def _load_specs(t2r_assets_file_path):
+  """Loads the feature and label specs from the t2r assets file.
+
+  The parsed specs of the most recently loaded files are cached since parsing
+  wide feature specs is expensive when restoring predictors repeatedly. Cache
+  entries are invalidated if the modification time or the size of the file
+  changed. Note, modification times might only have a resolution of seconds.
+
+  Args:
+    t2r_assets_file_path: The path to the t2r_assets.pbtxt file.
+
+  Returns:
+    Copies of the feature and label TensorSpecStruct.
+  """
+  stat = tf.io.gfile.stat(t2r_assets_file_path)
+  file_version = (stat.mtime_nsec, stat.length)
+  specs = None
+  with _SPEC_CACHE_LOCK:
+    cached = _SPEC_CACHE.get(t2r_assets_file_path)
+    if cached is not None and cached[0] == file_version:
+      _SPEC_CACHE.move_to_end(t2r_assets_file_path)
+      specs = cached[1]
+
+  if specs is None:
+    t2r_assets = tensorspec_utils.load_t2r_assets_to_file(t2r_assets_file_path)
+    specs = (
+        tensorspec_utils.TensorSpecStruct.from_proto(
+            t2r_assets.feature_spec),  # pytype: disable=wrong-arg-types
+        tensorspec_utils.TensorSpecStruct.from_proto(
+            t2r_assets.label_spec))  # pytype: disable=wrong-arg-types
+    with _SPEC_CACHE_LOCK:
+      _SPEC_CACHE[t2r_assets_file_path] = (file_version, specs)
+      _SPEC_CACHE.move_to_end(t2r_assets_file_path)
+      while len(_SPEC_CACHE) > _SPEC_CACHE_SIZE:
+        _SPEC_CACHE.popitem(last=False)
+
+  # The specs are mutable, hence every predictor gets its own shallow copy. The
+  # ExtendedTensorSpecs themselves are immutable.
+  return tuple(
+      tensorspec_utils.TensorSpecStruct(list(spec.items())) for spec in specs)
+
+
+def _file_exists(filename):
+  """Returns True if filename exists, using a single stat call."""
+  try:
+    tf.io.gfile.stat(filename)
+  except tf.errors.NotFoundError:
+    return False
+  return True
+
+
+def _wait_for_inotify_event(filename, timeout):
+  """Blocks until the directory of filename changes, using inotify.
+
+  Only the deepest existing parent directory of filename is watched, i.e. if
+  the directory of filename does not exist yet we wake up once a parent
+  directory is created and the caller has to wait again.
+
+  Args:
+    filename: The path of the file we are waiting for.
+    timeout: The maximum time in seconds to block.
+
+  Returns:
+    False if inotify cannot be used for filename, e.g. on non-linux platforms
+    or remote filesystems, in which case the caller has to poll instead.
+  """
+  if not sys.platform.startswith('linux') or '://' in filename:
+    return False
+  directory = os.path.dirname(os.path.abspath(filename))
+  while not os.path.isdir(directory):
+    directory = os.path.dirname(directory)
+
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+  except (AttributeError, OSError):
+    return False
+  if fd < 0:
+    return False
+  try:
+    if libc.inotify_add_watch(fd, directory.encode(),
+                              _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE) < 0:
+      return False
+    # The file might have been written before the watch was added.
+    if not _file_exists(filename):
+      select.select([fd], [], [], timeout)
+    return True
+  finally:
+    os.close(fd)
+
+
+def _wait_for_file(filename, timeout):
+  """Waits for filename to exist.
+
+  Local files are watched with inotify, otherwise we fall back to polling with
+  an exponential backoff to limit the number of requests to remote
+  filesystems.
+
+  Args:
+    filename: The path of the file we are waiting for.
+    timeout: The maximum time in seconds to wait.
+
+  Returns:
+    True if the file exists, False if it did not appear within timeout seconds.
+  """
+  deadline = time.time() + timeout
+  sleep_time = _MIN_BUSY_WAITING_SLEEP_TIME_IN_SECS
+  while True:
+    if _file_exists(filename):
+      return True
+    remaining_time = deadline - time.time()
+    if remaining_time <= 0:
+      return False
+
+    logging.info('Waiting for %s to become available.', filename)
+    if not _wait_for_inotify_event(
+        filename, min(remaining_time, _BUSY_WAITING_SLEEP_TIME_IN_SECS)):
+      time.sleep(min(sleep_time, remaining_time))
+      sleep_time = min(2 * sleep_time, _BUSY_WAITING_SLEEP_TIME_IN_SECS)
+
+
+def _prepare_feature(f, spec_shape, spec_dtype):
+  """Casts f to the spec dtype and adds a batch dimension if missing.
+
+  Args:
+    f: A numpy array or tensor.
+    spec_shape: The shape of the feature spec as tuple, without batch dimension.
+    spec_dtype: The numpy dtype of the feature spec, None to skip casting.
+
+  Returns:
+    The batched feature.
+  """
+  if isinstance(f, tf.Tensor):
+    if f.shape.rank == len(spec_shape) + 1:
+      # Tensors, e.g. placeholders, are usually batched already.
+      return f
+  elif spec_dtype is not None:
+    # A no-op if the dtype matches already.
+    f = np.asarray(f).astype(spec_dtype, copy=False)
+  # Indexing with None creates the same view as np.expand_dims(f, 0) but
+  # with less dispatch overhead.
+  return f[None] if f.shape == spec_shape else f
+
+
+def _get_concrete_function_key(flat_tensors_or_specs):
+  """Returns a hashable key of the shapes and dtypes of flat inputs."""
+  return tuple((tuple(t.shape), tf.as_dtype(t.dtype))
+               for t in flat_tensors_or_specs)
+
+
+def _has_same_keys_and_structure(features, reference, sorted_reference_keys):
+  """Returns True if features can be flattened in line with reference.
+
+  Args:
+    features: The (flat) features to check.
+    reference: The flat reference spec or placeholder structure.
+    sorted_reference_keys: The sorted keys of reference as tuple.
+
+  Returns:
+    True if features is a mapping with exactly the keys of reference and the
+    same structure, False otherwise.
+  """
+  if not isinstance(features, collections.abc.Mapping):
+    return False
+  if tuple(sorted(features.keys())) != sorted_reference_keys:
+    return False
+  try:
+    tf.nest.assert_same_structure(features, reference, check_types=False)
+  except (TypeError, ValueError):
+    return False
+  return True
+
+
+def _get_batch_size(features):
+  """Returns the size of the leading batch dimension of batched features."""
+  return np.shape(tf.nest.flatten(features)[0])[0]
+
+
+class LazyPredictionDict(collections.abc.Mapping):
+  """Read-only mapping which converts prediction tensors to numpy on access.
+
+  Callers which only read some of the outputs of multi-head models avoid the
+  device to host copies of all other outputs. Converted outputs are memoized.
+  Values which are not tensors are returned as is, this allows tf.nest to
+  rebuild instances from (key, value) pairs of already converted outputs.
+  """
+
+  def __init__(self, predictions):
+    """Creates an instance.
+
+    Args:
+      predictions: A dict of (nested) prediction tensors or an iterable of
+        (key, value) pairs.
+    """
+    self._predictions = dict(predictions)
+    self._numpy_predictions = {}
+
+  def __getitem__(self, key):
+    if key not in self._numpy_predictions:
+      self._numpy_predictions[key] = tf.nest.map_structure(
+          lambda t: t.numpy() if isinstance(t, tf.Tensor) else t,
+          self._predictions[key])
+    return self._numpy_predictions[key]
+
+  def __iter__(self):
+    return iter(self._predictions)
+
+  def __len__(self):
+    return len(self._predictions)
+
 
 class SavedModelPredictorBase(abstract_predictor.AbstractPredictor):
   """Base SavedModel predictor.
@@ -36,21 +270,33 @@ class SavedModelPredictorBase(abstract_predictor.AbstractPredictor):
   See implementations for TF1 and TF2 below.
   """
 
-  def __init__(self, saved_model_path, timeout = 600):
+  def __init__(self,
+               saved_model_path,
+               timeout = 600,
+               num_async_workers = 1):
     """Creates an instance.
 
     Args:
       saved_model_path: A path to a directory containing the saved_model.
       timeout: (defaults to 600 seconds) If no checkpoint has been found after
         timeout seconds restore fails.
+      num_async_workers: The number of threads evaluating predict_async calls.
     """
     super(SavedModelPredictorBase, self).__init__()
     self._saved_model_path = saved_model_path
     self._timeout = timeout
     self._model = None
+    self._num_async_workers = num_async_workers
+    self._executor = None
+    self._executor_lock = threading.Lock()
 
     self._feature_spec = None  # type: tensorspec_utils.TensorSpecStruct
     self._label_spec = None
+    # The flattened feature spec shapes and numpy dtypes, used to prepare the
+    # features.
+    self._flat_spec_shapes = None
+    self._flat_spec_dtypes = None
+    self._sorted_spec_keys = None
 
   def predict(self, features):
     """Predicts based on feature input using the loaded model.
@@ -62,17 +308,77 @@ class SavedModelPredictorBase(abstract_predictor.AbstractPredictor):
       The result of the queried model predictions.
     """
     self.assert_is_loaded()
+    return self.predict_prepared(self.prepare_features(features))
 
-    def _maybe_expand_dims(f, spec):
-      if list(f.shape) == spec.shape.as_list():
-        return np.expand_dims(f, 0)
-      return f
+  def predict_prepared(self, prepared_features):
+    """Predicts based on features returned by prepare_features.
+
+    Skips the validation and preparation of the features, e.g. for features
+    which have been prepared and concatenated by a batching wrapper.
+
+    Args:
+      prepared_features: The result of one or more concatenated
+        prepare_features calls.
+
+    Returns:
+      The result of the queried model predictions.
+    """
+    self.assert_is_loaded()
+    return self._model.predict(prepared_features)
 
-    expanded_features = tf.nest.map_structure(_maybe_expand_dims, features,
-                                              self.get_feature_specification())
-    predictions = self._model.predict(expanded_features)
+  def predict_async(self, features):
+    """Predicts asynchronously based on feature input using the loaded model.
 
-    return predictions
+    The predictions are evaluated by a pool of num_async_workers threads which
+    allows callers to e.g. preprocess the next features in the meantime.
+    TensorFlow releases the GIL while executing ops, hence several workers do
+    evaluate the model in parallel. Note, on GPUs concurrent evaluations
+    contend for the same device, throughput typically stops increasing or even
+    drops beyond a few workers.
+
+    Args:
+      features: A dict containing the features used for predictions.
+
+    Returns:
+      A concurrent.futures.Future resolving to the result of the queried model
+      predictions.
+    """
+    self.assert_is_loaded()
+    with self._executor_lock:
+      if self._executor is None:
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=self._num_async_workers)
+      return self._executor.submit(self.predict, features)
+
+  def prepare_features(self, features):
+    """Casts features to the spec dtypes and adds missing batch dimensions.
+
+    Features are processed in a single pass over the flattened features and
+    the flattened specs precomputed in restore.
+
+    Args:
+      features: A dict containing the features used for predictions.
+
+    Returns:
+      The batched features which can be passed to predict_prepared.
+
+    Raises:
+      ValueError: If the keys or structure of the features do not match the
+        feature specification.
+    """
+    if not _has_same_keys_and_structure(features, self._feature_spec,
+                                        self._sorted_spec_keys):
+      raise ValueError(
+          'The features do not match the feature specification with keys '
+          '{}.'.format(self._sorted_spec_keys))
+    # Mappings are flattened in sorted key order, hence the flat features line
+    # up with the flat specs.
+    flat_features = tf.nest.flatten(features)
+    return tf.nest.pack_sequence_as(features, [
+        _prepare_feature(f, spec_shape, spec_dtype)
+        for f, spec_shape, spec_dtype in zip(
+            flat_features, self._flat_spec_shapes, self._flat_spec_dtypes)
+    ])
 
   def get_feature_specification(self):
     """Exposes the required input features for evaluation of the model."""
@@ -94,17 +400,9 @@ class SavedModelPredictorBase(abstract_predictor.AbstractPredictor):
     t2r_assets_filename = os.path.join(t2r_assets_dir,
                                        tensorspec_utils.T2R_ASSETS_FILENAME)
 
-    start_time = time.time()
-    while time.time() - start_time < self._timeout:
-      # Check for the assets.extra/t2r_assets.pbtxt file which is materialized
-      # last. Otherwise we should check for saved_model.pb
-      if tf.io.gfile.exists(t2r_assets_filename):
-        break
-
-      logging.info('Waiting for a saved model to become available at %s.',
-                   self._saved_model_dir)
-      time.sleep(_BUSY_WAITING_SLEEP_TIME_IN_SECS)
-    else:
+    # Wait for the assets.extra/t2r_assets.pbtxt file which is materialized
+    # last. Otherwise we should check for saved_model.pb
+    if not _wait_for_file(t2r_assets_filename, self._timeout):
       logging.warning('No saved_model found after %s seconds.',
                       str(self._timeout))
       return False
@@ -113,12 +411,15 @@ class SavedModelPredictorBase(abstract_predictor.AbstractPredictor):
     t2r_assets_file_path = os.path.join(self._saved_model_path,
                                         tensorspec_utils.EXTRA_ASSETS_DIRECTORY,
                                         tensorspec_utils.T2R_ASSETS_FILENAME)
-    t2r_assets = tensorspec_utils.load_t2r_assets_to_file(t2r_assets_file_path)
-
-    self._feature_spec = tensorspec_utils.TensorSpecStruct.from_proto(
-        t2r_assets.feature_spec)  # pytype: disable=wrong-arg-types
-    self._label_spec = tensorspec_utils.TensorSpecStruct.from_proto(
-        t2r_assets.label_spec)  # pytype: disable=wrong-arg-types
+    self._feature_spec, self._label_spec = _load_specs(t2r_assets_file_path)
+    self._sorted_spec_keys = tuple(sorted(self._feature_spec.keys()))
+    flat_feature_spec = tf.nest.flatten(self._feature_spec)
+    self._flat_spec_shapes = tuple(
+        tuple(spec.shape.as_list()) for spec in flat_feature_spec)
+    # Strings are fed as is, numpy has no fixed size equivalent of tf.string.
+    self._flat_spec_dtypes = tuple(
+        None if spec.dtype == tf.string else spec.dtype.as_numpy_dtype
+        for spec in flat_feature_spec)
 
     self._model = tf.saved_model.load(self._saved_model_path)
     return True
@@ -134,6 +435,11 @@ class SavedModelPredictorBase(abstract_predictor.AbstractPredictor):
     Raises a ValueError if the predictor has not been restored yet.
     """
     self.assert_is_loaded()
+    with self._executor_lock:
+      executor = self._executor
+      self._executor = None
+    if executor is not None:
+      executor.shutdown()
 
   def assert_is_loaded(self):
     if self._model is None:
@@ -167,9 +473,283 @@ class SavedModelTF2Predictor(SavedModelPredictorBase):
   any performance penalties when compared to the graph TF1.x version below.
   """
 
-  def predict(self, features):
-    predictions = super(SavedModelTF2Predictor, self).predict(features)
-    return tf.nest.map_structure(lambda t: t.numpy(), predictions)
+  def __init__(self,
+               saved_model_path,
+               timeout = 600,
+               num_async_workers = 1,
+               inter_op_threads = None,
+               intra_op_threads = None,
+               enable_xla = False,
+               grappler_options = None,
+               quantize = None,
+               representative_dataset = None,
+               reuse_output_buffers = False,
+               lazy_predictions = False):
+    """Creates an instance.
+
+    Note, the threading, XLA and grappler configuration is process wide and can
+    only be changed before the TensorFlow runtime has been initialized, i.e.
+    before any op has been executed.
+
+    Args:
+      saved_model_path: A path to a directory containing the saved_model.
+      timeout: (defaults to 600 seconds) If no checkpoint has been found after
+        timeout seconds restore fails.
+      num_async_workers: The number of threads evaluating predict_async calls.
+      inter_op_threads: (Optional) The number of threads used to run
+        independent ops in parallel, by default chosen by TensorFlow.
+      intra_op_threads: (Optional) The number of threads used within a single
+        op, by default chosen by TensorFlow.
+      enable_xla: If True, XLA auto-clustering is enabled for the loaded
+        functions.
+      grappler_options: (Optional) A dict of grappler optimizer options, e.g.
+        {'constant_folding': True, 'layout_optimizer': True}, see
+        tf.config.optimizer.set_experimental_options.
+      quantize: (Optional) Either 'fp16' or 'int8'. If set, the loaded model
+        is converted with post-training quantization to TFLite and evaluated
+        with the TFLite interpreter.
+      representative_dataset: (Optional) A callable returning an iterable of
+        features used to calibrate the activation ranges, required for 'int8'
+        quantization.
+      reuse_output_buffers: If True, predictions are copied into two
+        alternating sets of preallocated numpy arrays instead of fresh arrays,
+        i.e. the result of a predict call is only valid until the next but one
+        call. Only use this with a single thread calling predict, it cannot be
+        combined with quantize, num_async_workers > 1 or
+        BatchingSavedModelPredictor.
+      lazy_predictions: If True, dict predictions are returned as a
+        LazyPredictionDict which only copies the outputs which are actually
+        accessed to numpy. Cannot be combined with quantize or
+        reuse_output_buffers.
+
+    Raises:
+      ValueError: If the quantization or output configuration is invalid.
+    """
+    super(SavedModelTF2Predictor, self).__init__(saved_model_path, timeout,
+                                                 num_async_workers)
+    if quantize not in _QUANTIZATION_MODES:
+      raise ValueError('Unsupported quantization {}, must be one of {}.'.format(
+          quantize, _QUANTIZATION_MODES))
+    if quantize == 'int8' and representative_dataset is None:
+      raise ValueError('int8 quantization requires a representative_dataset.')
+    self._quantize = quantize
+    self._representative_dataset = representative_dataset
+    # The TFLite signature runner is not thread-safe.
+    self._tflite_runner = None
+    self._tflite_lock = threading.Lock()
+    self._output_structure = None
+    self._reuse_output_buffers = reuse_output_buffers
+    self._output_buffers = [None, None]
+    self._output_buffers_index = 0
+    if lazy_predictions and reuse_output_buffers:
+      raise ValueError('lazy_predictions and reuse_output_buffers cannot be '
+                       'used together.')
+    if lazy_predictions and quantize is not None:
+      # The TFLite interpreter returns numpy arrays already.
+      raise ValueError('lazy_predictions and quantize cannot be used '
+                       'together.')
+    if quantize is not None and reuse_output_buffers:
+      raise ValueError('quantize and reuse_output_buffers cannot be used '
+                       'together.')
+    if num_async_workers > 1 and reuse_output_buffers:
+      # Concurrent predict_async workers would hand out the same buffers.
+      raise ValueError('reuse_output_buffers requires num_async_workers=1.')
+    self._lazy_predictions = lazy_predictions
+    try:
+      if inter_op_threads is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+      if intra_op_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    except RuntimeError as e:
+      logging.warning('Could not configure the TensorFlow thread pools: %s', e)
+    if enable_xla:
+      tf.config.optimizer.set_jit(True)
+    if grappler_options:
+      tf.config.optimizer.set_experimental_options(grappler_options)
+    # A concrete function accepting any batch size if the saved model provides
+    # one, otherwise concrete functions are cached per input shape and dtype.
+    self._batched_concrete_fn = None
+    self._concrete_fns = {}
+    # The accelerator the features are prefetched to, None for the CPU.
+    self._device = None
+
+  def prefetch(self, features):
+    """Copies features onto the accelerator ahead of a predict call.
+
+    Pipelined clients can stage the features of the next request while the
+    current one is evaluated and pass the returned tensors to predict later
+    on. Since kernel launches on GPUs are asynchronous the host to device copy
+    overlaps with whatever the client does in the meantime.
+
+    Args:
+      features: A dict containing the features used for predictions.
+
+    Returns:
+      The batched features as tensors placed on the accelerator.
+    """
+    self.assert_is_loaded()
+    expanded_features = self.prepare_features(features)
+    with tf.device(self._device):
+      return tf.nest.map_structure(tf.identity, expanded_features)
+
+  def predict_prepared(self, prepared_features):
+    self.assert_is_loaded()
+    if self._tflite_runner is not None:
+      return self._predict_tflite(prepared_features)
+    concrete_fn = self._get_concrete_function(prepared_features)
+    predictions = concrete_fn(prepared_features)
+    if self._lazy_predictions and isinstance(predictions,
+                                             collections.abc.Mapping):
+      return LazyPredictionDict(predictions)
+    # Flatten once and convert in a single pass instead of recursing into the
+    # prediction structure with a python callback per output.
+    flat_predictions = tf.nest.flatten(predictions)
+    if self._reuse_output_buffers:
+      return tf.nest.pack_sequence_as(
+          predictions, self._copy_to_output_buffers(flat_predictions))
+    return tf.nest.pack_sequence_as(predictions,
+                                    [t.numpy() for t in flat_predictions])
+
+  def _copy_to_output_buffers(self, flat_predictions):
+    """Copies the predictions into the next set of output buffers.
+
+    Buffers are only reallocated if the shape or dtype of the predictions
+    changed, e.g. for a different batch size.
+
+    Args:
+      flat_predictions: The flattened prediction tensors.
+
+    Returns:
+      The list of numpy output buffers containing the predictions.
+    """
+    buffers = self._output_buffers[self._output_buffers_index]
+    if buffers is None or any(
+        b.shape != tuple(t.shape) or b.dtype != t.dtype.as_numpy_dtype
+        for b, t in zip(buffers, flat_predictions)):
+      buffers = [
+          np.empty(t.shape, t.dtype.as_numpy_dtype) for t in flat_predictions
+      ]
+      self._output_buffers[self._output_buffers_index] = buffers
+    self._output_buffers_index = 1 - self._output_buffers_index
+    for buffer, prediction in zip(buffers, flat_predictions):
+      np.copyto(buffer, prediction)
+    return buffers
+
+  def _predict_tflite(self, features):
+    """Evaluates the quantized TFLite model."""
+    flat_features = tf.nest.flatten(features)
+    with self._tflite_lock:
+      outputs = self._tflite_runner(**{
+          _TFLITE_INPUT_NAME.format(i): np.asarray(f)
+          for i, f in enumerate(flat_features)
+      })
+    return tf.nest.pack_sequence_as(self._output_structure, [
+        outputs[_TFLITE_OUTPUT_NAME.format(i)] for i in range(len(outputs))
+    ])
+
+  def _convert_to_tflite(self):
+    """Quantizes the predict function of the model with TFLite.
+
+    Returns:
+      The signature runner of the TFLite interpreter.
+    """
+    if self._batched_concrete_fn is not None:
+      concrete_fn = self._batched_concrete_fn
+    else:
+      concrete_fn = self._model.predict.concrete_functions[0]
+    input_structure = concrete_fn.structured_input_signature[0][0]
+    self._output_structure = concrete_fn.structured_outputs
+
+    # TFLite signatures only support flat inputs and outputs, hence we wrap the
+    # predict function with explicitly named flat inputs and outputs.
+    flat_input_signature = [
+        tf.TensorSpec(spec.shape, spec.dtype, name=_TFLITE_INPUT_NAME.format(i))
+        for i, spec in enumerate(tf.nest.flatten(input_structure))
+    ]
+
+    @tf.function(input_signature=flat_input_signature, autograph=False)
+    def flat_predict(*flat_features):
+      predictions = concrete_fn(
+          tf.nest.pack_sequence_as(input_structure, flat_features))
+      return {
+          _TFLITE_OUTPUT_NAME.format(i): prediction
+          for i, prediction in enumerate(tf.nest.flatten(predictions))
+      }
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [flat_predict.get_concrete_function()], self._model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if self._quantize == 'fp16':
+      converter.target_spec.supported_types = [tf.float16]
+    else:
+
+      def representative_dataset():
+        for features in self._representative_dataset():
+          flat_features = tf.nest.flatten(self.prepare_features(features))
+          yield {
+              _TFLITE_INPUT_NAME.format(i): f
+              for i, f in enumerate(flat_features)
+          }
+
+      converter.representative_dataset = representative_dataset
+    interpreter = tf.lite.Interpreter(model_content=converter.convert())
+    return interpreter.get_signature_runner()
+
+  def _get_concrete_function(self, features):
+    """Returns a traced concrete function for the given (batched) features.
+
+    Calling the concrete function directly skips the python dispatch and
+    signature matching of the restored tf.function on every call.
+
+    Args:
+      features: The batched features passed to the model.
+
+    Returns:
+      A concrete function accepting features.
+    """
+    if self._batched_concrete_fn is not None:
+      return self._batched_concrete_fn
+
+    key = _get_concrete_function_key(tf.nest.flatten(features))
+    concrete_fn = self._concrete_fns.get(key)
+    if concrete_fn is None:
+      input_signature = tf.nest.map_structure(
+          lambda f: tf.TensorSpec(f.shape, f.dtype), features)
+      concrete_fn = self._model.predict.get_concrete_function(input_signature)
+      self._concrete_fns[key] = concrete_fn
+    return concrete_fn
+
+  def restore(self):
+    if not super(SavedModelTF2Predictor, self).restore():
+      return False
+
+    # Reuse the functions traced when the model was saved, they are called
+    # directly without retracing on the first predict call.
+    self._concrete_fns = {}
+    for concrete_fn in self._model.predict.concrete_functions:
+      flat_input_signature = tf.nest.flatten(
+          concrete_fn.structured_input_signature)
+      if all(spec.shape.is_fully_defined() for spec in flat_input_signature):
+        self._concrete_fns[_get_concrete_function_key(
+            flat_input_signature)] = concrete_fn
+
+    input_signature = tf.nest.map_structure(
+        lambda spec: tf.TensorSpec([None] + spec.shape.as_list(), spec.dtype),
+        self._feature_spec)
+    try:
+      self._batched_concrete_fn = self._model.predict.get_concrete_function(
+          input_signature)
+    except (TypeError, ValueError):
+      # The saved model has only been traced for fixed batch sizes.
+      logging.info('No batch size agnostic predict function found in %s, '
+                   'falling back to per batch size concrete functions.',
+                   self._saved_model_path)
+      self._batched_concrete_fn = None
+    if tf.config.list_logical_devices('GPU'):
+      self._device = '/GPU:0'
+    if self._quantize is not None:
+      self._tflite_runner = self._convert_to_tflite()
+    return True
 
   @property
   def global_step(self):
@@ -188,7 +768,8 @@ class SavedModelTF1Predictor(SavedModelPredictorBase):
   def __init__(self,
                saved_model_path,
                timeout = 600,
-               tf_config = None):
+               tf_config = None,
+               num_async_workers = 1):
     """Creates an instance.
 
     Args:
@@ -196,26 +777,55 @@ class SavedModelTF1Predictor(SavedModelPredictorBase):
       timeout: (defaults to 600 seconds) If no checkpoint has been found after
         timeout seconds restore fails.
       tf_config: The tf.ConfigProto used to configure the TensorFlow session.
+        By default the session uses its own thread pools in order to not
+        compete with other predictors in the same process.
+      num_async_workers: The number of threads evaluating predict_async calls,
+        the session supports concurrent runs.
     """
-    super(SavedModelTF1Predictor, self).__init__(saved_model_path, timeout)
+    super(SavedModelTF1Predictor, self).__init__(saved_model_path, timeout,
+                                                 num_async_workers)
+    if tf_config is None:
+      tf_config = tf.compat.v1.ConfigProto(use_per_session_threads=True)
     self._tf_config = tf_config
-    self._graph = tf.compat.v1.Graph()
-    self._session = tf.compat.v1.Session(graph=self._graph, config=tf_config)
+    # The graph and session are created lazily on restore.
+    self._graph = None
+    self._session = None
     self._predictions = None
     self._features = None
+    self._flat_placeholders = None
+    self._sorted_feature_keys = None
+    self._predict_callable = None
+    self._global_step = None
 
   def predict(self, features):
     self.assert_is_loaded()
 
-    # Forcing both session and graph to be defaults here to force a graph
-    # context if this ever gets used during Eager execution. Makes testing
-    # easier too.
-    with self._session.as_default(), self._graph.as_default():
+    # Running the session does not require a default graph or session, hence
+    # we can skip entering them on this hot path.
+    if not _has_same_keys_and_structure(features, self._features,
+                                        self._sorted_feature_keys):
+      # E.g. optional features are missing, map_feed_dict validates the
+      # features against the placeholders and raises meaningful errors.
       return self._session.run(
           self._predictions,
           tensorspec_utils.map_feed_dict(self._features, features))
+    # Mappings are flattened in sorted key order, hence the flat features line
+    # up with the flat placeholders.
+    return self._predict_callable(*tf.nest.flatten(features))
+
+  def predict_prepared(self, prepared_features):
+    self.assert_is_loaded()
+    return self._predict_callable(*tf.nest.flatten(prepared_features))
+
+  def _ensure_session(self):
+    """Creates the graph and session on first use."""
+    if self._session is None:
+      self._graph = tf.compat.v1.Graph()
+      self._session = tf.compat.v1.Session(
+          graph=self._graph, config=self._tf_config)
 
   def restore(self):
+    self._ensure_session()
     # Forcing both session and graph to be defaults here to force a graph
     # context if this ever gets used during Eager execution. Makes testing
     # easier too.
@@ -225,16 +835,227 @@ class SavedModelTF1Predictor(SavedModelPredictorBase):
 
       self._features = tensorspec_utils.make_placeholders(
           self._feature_spec, batch_size=None)
-      self._predictions = super(SavedModelTF1Predictor,
-                                self).predict(self._features)
+      self._flat_placeholders = tf.nest.flatten(self._features)
+      self._sorted_feature_keys = tuple(sorted(self._features.keys()))
+      self._predictions = super(SavedModelTF1Predictor, self).predict_prepared(
+          self.prepare_features(self._features))
+      # Models without a global_step function are valid, the global step
+      # tensor is built on first access.
+      self._global_step = None
       # After loading the model we need to make sure we initialize the
       # variables.
       variables = (
           tf.compat.v1.global_variables() + tf.compat.v1.local_variables())
       self._session.run(tf.compat.v1.variables_initializer(variables))
+      # Callables avoid building a feed dict and most of the python overhead
+      # of session.run for every prediction.
+      self._predict_callable = self._session.make_callable(
+          self._predictions, self._flat_placeholders)
+    return True
 
   @property
   def global_step(self):
     """The global step of the model currently in use."""
     self.assert_is_loaded()
-    return self._session.run(super(SavedModelTF1Predictor, self).global_step())
+    if self._global_step is None:
+      with self._graph.as_default():
+        self._global_step = super(SavedModelTF1Predictor, self).global_step
+    return self._session.run(self._global_step)
+
+
+@gin.configurable
+class BatchingSavedModelPredictor(abstract_predictor.AbstractPredictor):
+  """Coalesces concurrent predict calls into batched model evaluations.
+
+  Similar to the BasicBatchScheduler of TF-Serving, incoming predict calls are
+  queued and batch threads concatenate the features of up to max_batch_size
+  examples, or whatever arrived within batch_timeout_micros, along the batch
+  dimension. A single model evaluation is run for the whole batch and the
+  predictions are split and handed back to the individual callers. This trades
+  up to batch_timeout_micros of additional latency for throughput.
+  """
+
+  def __init__(self,
+               predictor,
+               max_batch_size = 32,
+               batch_timeout_micros = 1000,
+               num_batch_threads = 1):
+    """Creates an instance.
+
+    Args:
+      predictor: The SavedModelPredictorBase used to evaluate the batches.
+      max_batch_size: The maximum number of examples evaluated at once.
+      batch_timeout_micros: The maximum time in microseconds a batch thread
+        waits for additional requests before evaluating an incomplete batch.
+      num_batch_threads: The number of threads evaluating batches in parallel.
+
+    Raises:
+      ValueError: If the predictor reuses its output buffers.
+    """
+    super(BatchingSavedModelPredictor, self).__init__()
+    if getattr(predictor, '_reuse_output_buffers', False):
+      # The predictions of all callers would be views into buffers which are
+      # overwritten by later batches.
+      raise ValueError('Predictors reusing output buffers cannot be batched.')
+    self._predictor = predictor
+    self._max_batch_size = max_batch_size
+    self._batch_timeout_secs = batch_timeout_micros / 1e6
+    self._num_batch_threads = num_batch_threads
+    self._queue = queue.Queue()
+    self._batch_threads = []
+    # Guards enqueueing requests against close() enqueueing the stop sentinels,
+    # requests enqueued after the sentinels would never be evaluated.
+    self._lock = threading.Lock()
+
+  def predict(self, features):
+    """Predicts based on feature input using the loaded model.
+
+    Args:
+      features: A dict containing the features used for predictions.
+
+    Returns:
+      The result of the queried model predictions.
+    """
+    self.assert_is_loaded()
+    # The features are validated and prepared in the caller thread, the batch
+    # threads only concatenate them.
+    prepared_features = self._predictor.prepare_features(features)
+    batch_size = _get_batch_size(prepared_features)
+    future = futures.Future()
+    with self._lock:
+      if not self._batch_threads:
+        raise ValueError('The predictor has already been closed.')
+      self._queue.put((prepared_features, batch_size, future))
+    return future.result()
+
+  def _run_batch_thread(self):
+    """Evaluates queued requests in batches until None is dequeued.
+
+    Requests are (features, batch_size, future) tuples.
+    """
+    pending = None
+    stop = False
+    while not stop:
+      request = pending if pending is not None else self._queue.get()
+      pending = None
+      if request is None:
+        return
+
+      batch = [request]
+      batch_size = request[1]
+      deadline = time.time() + self._batch_timeout_secs
+      while batch_size < self._max_batch_size:
+        try:
+          request = self._queue.get(timeout=max(0., deadline - time.time()))
+        except queue.Empty:
+          break
+        if request is None:
+          stop = True
+          break
+        request_size = request[1]
+        if batch_size + request_size > self._max_batch_size:
+          # The request is evaluated with the next batch.
+          pending = request
+          break
+        batch.append(request)
+        batch_size += request_size
+      self._run_batch(batch)
+
+  def _run_batch(self, batch):
+    """Evaluates a list of requests as a single batch.
+
+    Every future of the batch is resolved, failures are propagated to all
+    callers which did not receive a result yet.
+
+    Args:
+      batch: A list of (features, batch_size, future) requests.
+    """
+    batch_features, sizes, batch_futures = zip(*batch)
+    try:
+      if len(batch) == 1:
+        batch_futures[0].set_result(
+            self._predictor.predict_prepared(batch_features[0]))
+        return
+
+      flat_features = [tf.nest.flatten(f) for f in batch_features]
+      features = tf.nest.pack_sequence_as(
+          batch_features[0],
+          [np.concatenate(leaves, axis=0) for leaves in zip(*flat_features)])
+      predictions = self._predictor.predict_prepared(features)
+
+      split_indices = np.cumsum(sizes)[:-1]
+      total_size = sum(sizes)
+      flat_predictions = tf.nest.flatten(predictions)
+      split_predictions = []
+      for prediction in flat_predictions:
+        if np.ndim(prediction) and np.shape(prediction)[0] == total_size:
+          split_predictions.append(np.split(prediction, split_indices, axis=0))
+        else:
+          # Predictions without a batch dimension are shared by all requests.
+          split_predictions.append([prediction] * len(batch))
+
+      for i, future in enumerate(batch_futures):
+        future.set_result(
+            tf.nest.pack_sequence_as(
+                predictions, [leaves[i] for leaves in split_predictions]))
+    except Exception as e:  # pylint: disable=broad-except
+      for future in batch_futures:
+        if not future.done():
+          future.set_exception(e)
+
+  def get_feature_specification(self):
+    """Exposes the required input features for evaluation of the model."""
+    return self._predictor.get_feature_specification()
+
+  def get_label_specification(
+      self):
+    """Exposes the optional labels for evaluation of the model."""
+    return self._predictor.get_label_specification()
+
+  def restore(self):
+    """Restores the model parameters and starts the batch threads."""
+    if not self._predictor.restore():
+      return False
+    with self._lock:
+      if not self._batch_threads:
+        for _ in range(self._num_batch_threads):
+          batch_thread = threading.Thread(target=self._run_batch_thread)
+          batch_thread.daemon = True
+          batch_thread.start()
+          self._batch_threads.append(batch_thread)
+    return True
+
+  def init_randomly(self):
+    """Initializes model parameters from with random values."""
+    self._predictor.init_randomly()
+
+  def close(self):
+    """Stops the batch threads and closes the wrapped predictor."""
+    with self._lock:
+      batch_threads = self._batch_threads
+      self._batch_threads = []
+      for _ in batch_threads:
+        self._queue.put(None)
+    # Requests enqueued before the sentinels are still evaluated.
+    for batch_thread in batch_threads:
+      batch_thread.join()
+    self._predictor.close()
+
+  def assert_is_loaded(self):
+    self._predictor.assert_is_loaded()
+
+  @property
+  def model_version(self):
+    """The version of the model currently in use."""
+    return self._predictor.model_version
+
+  @property
+  def global_step(self):
+    """The global step of the model currently in use."""
+    return self._predictor.global_step
+
+  @property
+  def model_path(self):
+    """The path of the model currently in use."""
+    return self._predictor.model_path
+
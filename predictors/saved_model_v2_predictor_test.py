@@ -17,6 +17,8 @@
 """Tests for tensor2robot.predictors.saved_model_v2_predictor."""
 
 import os
+import threading
+import mock
 import numpy as np
 
 from tensor2robot.predictors import saved_model_v2_predictor
@@ -27,12 +29,37 @@ from tensor2robot.utils import tensorspec_utils
 import tensorflow.compat.v2 as tf
 
 _BATCH_SIZE = 2
+_GLOBAL_STEP = 7
 
 
 def setUpModule():
   tf.enable_v2_behavior()
 
 
+class _FailingPredictor(object):
+  """Minimal predictor whose predictions fail until fail is set to False."""
+
+  def __init__(self):
+    self.fail = True
+
+  def prepare_features(self, features):
+    return features
+
+  def predict_prepared(self, prepared_features):
+    if self.fail:
+      raise RuntimeError('Prediction failed.')
+    return prepared_features
+
+  def restore(self):
+    return True
+
+  def assert_is_loaded(self):
+    pass
+
+  def close(self):
+    pass
+
+
 def _generate_assets(model, export_dir):
   in_feature_spec = model.get_feature_specification_for_packing(
       mode=tf.estimator.ModeKeys.PREDICT)
@@ -56,13 +83,21 @@ def _generate_assets(model, export_dir):
   tensorspec_utils.write_t2r_assets_to_file(t2r_assets, t2r_assets_filename)
 
 
+def _misspell_features(features):
+  """Returns a copy of features with a misspelled key."""
+  misspelled_features = dict(features.items())
+  key = sorted(misspelled_features)[0]
+  misspelled_features[key + '_misspelled'] = misspelled_features.pop(key)
+  return misspelled_features
+
+
 class SavedModelV2PredictorTest(tf.test.TestCase):
 
   def __init__(self, *args, **kwargs):
     super(SavedModelV2PredictorTest, self).__init__(*args, **kwargs)
     self._saved_model_path = None
 
-  def _save_model(self, model, sample_features):
+  def _save_model(self, model, sample_features, global_step=None):
     if self._saved_model_path:
       return self._saved_model_path
 
@@ -76,11 +111,44 @@ class SavedModelV2PredictorTest(tf.test.TestCase):
     predict(sample_features)
     model.predict = predict
 
+    if global_step is not None:
+      # Expose a fixed global step which is restored by the predictors.
+      model.global_step_variable = tf.Variable(global_step, dtype=tf.int64)
+
+      @tf.function(autograph=False, input_signature=[])
+      def global_step_fn():
+        return model.global_step_variable.read_value()
+
+      model.global_step = global_step_fn
+
     self._saved_model_path = self.create_tempdir().full_path
     tf.saved_model.save(model, self._saved_model_path)
     _generate_assets(model, self._saved_model_path)
     return self._saved_model_path
 
+  def _restore_predictor(self, predictor_fn, global_step=None):
+    """Saves a mock model and restores a predictor for it.
+
+    Args:
+      predictor_fn: A callable creating the predictor from a saved model path.
+      global_step: (Optional) The global step exported with the model.
+
+    Returns:
+      A tuple of the restored predictor, batched sample features and the
+      predictions of the original model for these features.
+    """
+    mock_model = mocks.MockTF2T2RModel()
+    feature_spec = mock_model.preprocessor.get_in_feature_specification(
+        tf.compat.v1.estimator.ModeKeys.PREDICT)
+    sample_features = tensorspec_utils.make_random_numpy(
+        feature_spec, batch_size=_BATCH_SIZE)
+    path = self._save_model(mock_model, sample_features, global_step)
+    predictor = predictor_fn(path)
+    self.assertTrue(predictor.restore())
+    original_model_out = mock_model.inference_network_fn(
+        sample_features, None, tf.compat.v1.estimator.ModeKeys.PREDICT)
+    return predictor, sample_features, original_model_out
+
   def _test_predictor(self, predictor_cls):
     mock_model = mocks.MockTF2T2RModel()
 
@@ -109,12 +177,255 @@ class SavedModelV2PredictorTest(tf.test.TestCase):
     np.testing.assert_almost_equal(original_model_out['logits'],
                                    predictor_out['logits'])
 
+    predictor_async_out = saved_model_predictor.predict_async(
+        sample_features).result()
+    np.testing.assert_almost_equal(original_model_out['logits'],
+                                   predictor_async_out['logits'])
+    saved_model_predictor.close()
+
   def testTF1Predictor(self):
     self._test_predictor(saved_model_v2_predictor.SavedModelTF1Predictor)
 
+  def _test_predictor_global_step(self, predictor_cls):
+    predictor, _, _ = self._restore_predictor(
+        predictor_cls, global_step=_GLOBAL_STEP)
+    self.assertEqual(predictor.global_step, _GLOBAL_STEP)
+    predictor.close()
+
+  def testTF1PredictorGlobalStep(self):
+    self._test_predictor_global_step(
+        saved_model_v2_predictor.SavedModelTF1Predictor)
+
+  def testTF2PredictorGlobalStep(self):
+    self._test_predictor_global_step(
+        saved_model_v2_predictor.SavedModelTF2Predictor)
+
+  def testTF1PredictorWithoutGlobalStep(self):
+    # Exporting a global_step function is optional.
+    predictor, sample_features, original_model_out = self._restore_predictor(
+        saved_model_v2_predictor.SavedModelTF1Predictor)
+    np.testing.assert_almost_equal(original_model_out['logits'],
+                                   predictor.predict(sample_features)['logits'])
+    predictor.close()
+
+  def _test_predictor_raises_on_misspelled_features(self, predictor_fn):
+    predictor, sample_features, _ = self._restore_predictor(predictor_fn)
+    with self.assertRaises(ValueError):
+      predictor.predict(_misspell_features(sample_features))
+    predictor.close()
+
+  def testTF1PredictorRaisesOnMisspelledFeatures(self):
+    self._test_predictor_raises_on_misspelled_features(
+        saved_model_v2_predictor.SavedModelTF1Predictor)
+
+  def testTF2PredictorRaisesOnMisspelledFeatures(self):
+    self._test_predictor_raises_on_misspelled_features(
+        saved_model_v2_predictor.SavedModelTF2Predictor)
+
+  def testBatchingPredictorRaisesOnMisspelledFeatures(self):
+    self._test_predictor_raises_on_misspelled_features(
+        lambda path: saved_model_v2_predictor.BatchingSavedModelPredictor(
+            saved_model_v2_predictor.SavedModelTF1Predictor(path)))
+
   def testTF2Predictor(self):
     self._test_predictor(saved_model_v2_predictor.SavedModelTF2Predictor)
 
+  def testTF2PredictorPrefetch(self):
+    predictor, sample_features, original_model_out = self._restore_predictor(
+        saved_model_v2_predictor.SavedModelTF2Predictor)
+
+    prefetched_features = predictor.prefetch(sample_features)
+    np.testing.assert_almost_equal(
+        original_model_out['logits'],
+        predictor.predict(prefetched_features)['logits'])
+    predictor.close()
+
+  def testTF2PredictorReusesOutputBuffers(self):
+    predictor, sample_features, _ = self._restore_predictor(
+        lambda path: saved_model_v2_predictor.SavedModelTF2Predictor(
+            path, reuse_output_buffers=True))
+    # The random examples in reverse order yield different predictions.
+    other_features = tf.nest.map_structure(lambda f: f[::-1], sample_features)
+    single_features = tf.nest.map_structure(lambda f: f[:1], sample_features)
+
+    logits_0 = predictor.predict(sample_features)['logits']
+    expected_logits_0 = logits_0.copy()
+    logits_1 = predictor.predict(other_features)['logits']
+    # The previous result stays valid for one more call.
+    self.assertIsNot(logits_0, logits_1)
+    np.testing.assert_equal(logits_0, expected_logits_0)
+
+    # The next but one call writes into the same buffer.
+    logits_2 = predictor.predict(other_features)['logits']
+    self.assertIs(logits_2, logits_0)
+    np.testing.assert_equal(logits_0, logits_1)
+
+    # Buffers are reallocated if the batch size changes.
+    logits_3 = predictor.predict(single_features)['logits']
+    self.assertIsNot(logits_3, logits_1)
+    self.assertEqual(logits_3.shape[0], 1)
+    predictor.close()
+
+  def testTF2PredictorReuseOutputBuffersRaises(self):
+    with self.assertRaises(ValueError):
+      saved_model_v2_predictor.SavedModelTF2Predictor(
+          'unused', reuse_output_buffers=True, quantize='fp16')
+    with self.assertRaises(ValueError):
+      saved_model_v2_predictor.SavedModelTF2Predictor(
+          'unused', reuse_output_buffers=True, num_async_workers=4)
+    with self.assertRaises(ValueError):
+      saved_model_v2_predictor.BatchingSavedModelPredictor(
+          saved_model_v2_predictor.SavedModelTF2Predictor(
+              'unused', reuse_output_buffers=True))
+
+  def testTF2PredictorLazyPredictions(self):
+    predictor, sample_features, original_model_out = self._restore_predictor(
+        lambda path: saved_model_v2_predictor.SavedModelTF2Predictor(
+            path, lazy_predictions=True))
+    predictor_out = predictor.predict(sample_features)
+    self.assertIsInstance(predictor_out,
+                          saved_model_v2_predictor.LazyPredictionDict)
+    self.assertIn('logits', predictor_out)
+    np.testing.assert_almost_equal(original_model_out['logits'],
+                                   predictor_out['logits'])
+
+    # tf.nest rebuilds mappings from (key, value) pairs of converted outputs.
+    mapped_out = tf.nest.map_structure(lambda x: x, predictor_out)
+    self.assertIsInstance(mapped_out,
+                          saved_model_v2_predictor.LazyPredictionDict)
+    np.testing.assert_almost_equal(predictor_out['logits'],
+                                   mapped_out['logits'])
+    packed_out = tf.nest.pack_sequence_as(predictor_out,
+                                          tf.nest.flatten(predictor_out))
+    np.testing.assert_almost_equal(predictor_out['logits'],
+                                   packed_out['logits'])
+
+    batching_predictor = saved_model_v2_predictor.BatchingSavedModelPredictor(
+        predictor)
+    self.assertTrue(batching_predictor.restore())
+    np.testing.assert_almost_equal(
+        original_model_out['logits'],
+        batching_predictor.predict(sample_features)['logits'])
+    # Also closes the wrapped predictor.
+    batching_predictor.close()
+
+  def testTF2PredictorLazyPredictionsRaises(self):
+    with self.assertRaises(ValueError):
+      saved_model_v2_predictor.SavedModelTF2Predictor(
+          'unused', lazy_predictions=True, quantize='fp16')
+    with self.assertRaises(ValueError):
+      saved_model_v2_predictor.SavedModelTF2Predictor(
+          'unused', lazy_predictions=True, reuse_output_buffers=True)
+
+  def testTF2PredictorQuantized(self):
+    predictor, sample_features, original_model_out = self._restore_predictor(
+        lambda path: saved_model_v2_predictor.SavedModelTF2Predictor(
+            path, quantize='fp16'))
+    np.testing.assert_almost_equal(
+        original_model_out['logits'],
+        predictor.predict(sample_features)['logits'],
+        decimal=2)
+    predictor.close()
+
+  def testBatchingPredictorPropagatesErrors(self):
+    failing_predictor = _FailingPredictor()
+    predictor = saved_model_v2_predictor.BatchingSavedModelPredictor(
+        failing_predictor,
+        max_batch_size=_BATCH_SIZE,
+        batch_timeout_micros=10 * 1000 * 1000)
+    self.assertTrue(predictor.restore())
+
+    errors = []
+
+    def _predict():
+      try:
+        predictor.predict({'x': np.ones((1, 3))})
+      except RuntimeError as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=_predict) for _ in range(_BATCH_SIZE)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertLen(errors, _BATCH_SIZE)
+
+    # The batch threads survive failed batches.
+    failing_predictor.fail = False
+    np.testing.assert_equal(
+        predictor.predict({'x': np.ones((1, 3))})['x'], np.ones((1, 3)))
+    predictor.close()
+    with self.assertRaises(ValueError):
+      predictor.predict({'x': np.ones((1, 3))})
+
+  def testLoadSpecsCache(self):
+    mock_model = mocks.MockTF2T2RModel()
+    export_dir = self.create_tempdir().full_path
+    _generate_assets(mock_model, export_dir)
+    t2r_assets_filename = os.path.join(export_dir,
+                                       tensorspec_utils.EXTRA_ASSETS_DIRECTORY,
+                                       tensorspec_utils.T2R_ASSETS_FILENAME)
+
+    with mock.patch.object(
+        tensorspec_utils,
+        'load_t2r_assets_to_file',
+        wraps=tensorspec_utils.load_t2r_assets_to_file) as load_mock:
+      feature_spec, label_spec = saved_model_v2_predictor._load_specs(
+          t2r_assets_filename)
+      cached_feature_spec, cached_label_spec = (
+          saved_model_v2_predictor._load_specs(t2r_assets_filename))
+      self.assertEqual(load_mock.call_count, 1)
+
+      # Every caller receives its own copy of the specs.
+      self.assertIsNot(feature_spec, cached_feature_spec)
+      tensorspec_utils.assert_equal(feature_spec, cached_feature_spec)
+      tensorspec_utils.assert_equal(label_spec, cached_label_spec)
+      del cached_feature_spec[sorted(cached_feature_spec.keys())[0]]
+      tensorspec_utils.assert_equal(
+          feature_spec,
+          saved_model_v2_predictor._load_specs(t2r_assets_filename)[0])
+      self.assertEqual(load_mock.call_count, 1)
+
+      # Rewriting the file invalidates the cache entry.
+      with tf.io.gfile.GFile(t2r_assets_filename, 'a') as f:
+        f.write('# Rewritten.\n')
+      saved_model_v2_predictor._load_specs(t2r_assets_filename)
+      self.assertEqual(load_mock.call_count, 2)
+
+  def testRestoreTimeout(self):
+    predictor = saved_model_v2_predictor.SavedModelTF2Predictor(
+        os.path.join(self.create_tempdir().full_path, 'does_not_exist'),
+        timeout=1)
+    self.assertFalse(predictor.restore())
+
+  def testBatchingPredictor(self):
+    # A long timeout ensures that the single example requests are evaluated
+    # as one full batch.
+    predictor, sample_features, original_model_out = self._restore_predictor(
+        lambda path: saved_model_v2_predictor.BatchingSavedModelPredictor(
+            saved_model_v2_predictor.SavedModelTF2Predictor(path),
+            max_batch_size=_BATCH_SIZE,
+            batch_timeout_micros=10 * 1000 * 1000))
+    predictor_outs = [None] * _BATCH_SIZE
+
+    def _predict(index):
+      example = tf.nest.map_structure(lambda f: f[index], sample_features)
+      predictor_outs[index] = predictor.predict(example)
+
+    threads = [
+        threading.Thread(target=_predict, args=(i,))
+        for i in range(_BATCH_SIZE)
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    predictor.close()
+
+    for i, predictor_out in enumerate(predictor_outs):
+      np.testing.assert_almost_equal(original_model_out['logits'][i:i + 1],
+                                     predictor_out['logits'])
+
 
 if __name__ == '__main__':
   tf.test.main()